@@ -1,10 +1,14 @@
 from pathlib import Path
 from dataclasses import dataclass
-from typing import Callable
+from typing import Callable, Iterable, Iterator
+import os
+import queue
 import random
+import threading
 
 import torch
 import numpy as np
+import jax
 import jax.numpy as jnp
 import torchvision
 import torchvision.transforms as transforms
@@ -75,6 +79,17 @@ def seed_everything(seed: int):
     random.seed(seed)
 
 
+def enable_compilation_cache():
+    """Persists the programs compiled by jax in the directory given by the 'PCAX_COMPILATION_CACHE_DIR' environment
+    variable, if set, so that runs with the same shapes (e.g., every seed or hypertuning trial) load them from disk
+    instead of compiling them again. It must be called before importing pcax, as jax sets up the cache at the first
+    compilation, which happens when pcax is imported.
+    """
+    cache_dir = os.environ.get("PCAX_COMPILATION_CACHE_DIR")
+    if cache_dir is not None:
+        jax.config.update("jax_compilation_cache_dir", cache_dir)
+
+
 def numpy_collate(batch):
     """This is a simple collate function that stacks numpy arrays used to interface the PyTorch dataloader with JAX.
     In the future we hope to provide custom dataloaders that are independent of PyTorch.
@@ -92,7 +107,7 @@ def numpy_collate(batch):
 
 # The dataloader assumes cuda is being used, as such it sets 'pin_memory = True' and
 # 'prefetch_factor = 2'. Note that the batch size should be constant during training, so
-# we set 'drop_last = True' to avoid having to deal with variable batch sizes.
+# 'drop_last = True' by default to avoid having to deal with variable batch sizes.
 class TorchDataloader(torch.utils.data.DataLoader):
     def __init__(
         self,
@@ -107,6 +122,7 @@ class TorchDataloader(torch.utils.data.DataLoader):
         worker_init_fn=None,
         persistent_workers=True,
         prefetch_factor=2,
+        drop_last=True,
     ):
         # https://pytorch.org/docs/stable/notes/randomness.html#dataloader
         def seed_worker(worker_id):
@@ -127,7 +143,7 @@ class TorchDataloader(torch.utils.data.DataLoader):
             num_workers=num_workers,
             collate_fn=numpy_collate,
             pin_memory=pin_memory,
-            drop_last=True if batch_sampler is None else None,
+            drop_last=drop_last if batch_sampler is None else None,
             timeout=timeout,
             worker_init_fn=seed_worker,
             generator=g,
@@ -136,6 +152,158 @@ class TorchDataloader(torch.utils.data.DataLoader):
         )
 
 
+class ArrayDataloader:
+    """Index-based dataloader over a dataset already stored as (device) arrays. Each batch is a single gather of the
+    selected rows, avoiding the per-sample transform, collate and host to device copy of the PyTorch dataloader.
+    As for 'TorchDataloader', the last incomplete batch is dropped unless 'drop_last = False'.
+    """
+
+    def __init__(self, x: jax.Array, y: jax.Array, batch_size: int, shuffle: bool = False, drop_last: bool = True):
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return self.x.shape[0] // self.batch_size
+        return -(-self.x.shape[0] // self.batch_size)
+
+    def __iter__(self):
+        n = self.x.shape[0]
+        indices = np.random.permutation(n) if self.shuffle else np.arange(n)
+        for i in range(len(self)):
+            batch_indices = indices[i * self.batch_size : (i + 1) * self.batch_size]
+            yield self.x[batch_indices], self.y[batch_indices]
+
+
+def prefetch_to_device(
+    iterable: Iterable, size: int = 2, sharding: jax.sharding.Sharding | None = None
+) -> Iterator:
+    """Iterates over 'iterable' while a background thread loads the next 'size' batches and moves them to device
+    (with the given sharding, if any). This overlaps the data loading and the host to device transfer with the
+    computation on the current batch. If the iteration stops early, the background thread stops as well.
+    """
+    batches = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item) -> bool:
+        # Waits for a free slot only while the consumer is still iterating, so that the thread (and the batches it
+        # holds on device) does not outlive an early exit.
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for batch in iterable:
+                if not put(jax.device_put(batch, sharding)):
+                    return
+        except BaseException as e:
+            put(e)
+        finally:
+            put(end)
+
+    threading.Thread(target=producer, daemon=True).start()
+
+    try:
+        while (batch := batches.get()) is not end:
+            if isinstance(batch, BaseException):
+                raise batch
+            yield batch
+    finally:
+        stop.set()
+
+
+class ArrayDataset(torch.utils.data.Dataset):
+    """Dataset over in-memory arrays, returning the raw samples without any per-sample transform."""
+
+    def __init__(self, x: np.ndarray, y: np.ndarray):
+        self.x = x
+        self.y = y
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, i):
+        return self.x[i], self.y[i]
+
+
+# CIFAR-10 normalisation factors found online.
+CIFAR10_MEAN = np.array((0.4914, 0.4822, 0.4465), dtype=np.float32)
+CIFAR10_STD = np.array((0.2023, 0.1994, 0.2010), dtype=np.float32)
+
+
+def random_flip_and_crop(x: np.ndarray, padding: int = 4) -> np.ndarray:
+    """Batched 'RandomHorizontalFlip(p=0.5)' followed by 'RandomCrop(size, padding)' on a channel-last uint8 batch.
+    Random numbers are drawn from torch, which is seeded differently in each dataloader worker.
+    """
+    b, h, w, _ = x.shape
+    flip = (torch.rand(b) < 0.5).numpy()
+    x = np.where(flip[:, None, None, None], x[:, :, ::-1], x)
+    x = np.pad(x, ((0, 0), (padding, padding), (padding, padding), (0, 0)))
+    i, j = torch.randint(0, 2 * padding + 1, (2, b)).numpy()
+    rows = (i[:, None] + np.arange(h))[:, :, None]
+    cols = (j[:, None] + np.arange(w))[:, None, :]
+
+    return x[np.arange(b)[:, None, None], rows, cols]
+
+
+def to_channel_first(x: np.ndarray) -> np.ndarray:
+    return np.ascontiguousarray(x.transpose(0, 3, 1, 2))
+
+
+def stack_collate(batch):
+    """Specialised 'numpy_collate' for the fixed '(image, label)' samples of 'ArrayDataset', skipping the per-sample
+    type checks and recursion.
+    """
+    return np.stack([sample[0] for sample in batch]), np.array([sample[1] for sample in batch])
+
+
+def train_collate(batch):
+    x, y = stack_collate(batch)
+    return to_channel_first(random_flip_and_crop(x)), y
+
+
+def test_collate(batch):
+    x, y = stack_collate(batch)
+    return to_channel_first(x), y
+
+
+def normalize(x: jax.Array) -> jax.Array:
+    """'ToTensor()' followed by 'Normalize(CIFAR10_MEAN, CIFAR10_STD)' on a channel-first uint8 batch. It is applied
+    inside the jitted steps, so that images are transferred to device as uint8 (4x less data than float32).
+    """
+    return (x.astype(jnp.float32) / 255.0 - CIFAR10_MEAN[None, :, None, None]) / CIFAR10_STD[None, :, None, None]
+
+
+# Datasets small enough to be kept on device as float32 and with no random augmentation, which can thus be
+# preprocessed once. CIFAR-10 is left out, as it would take about 740 MB.
+IN_MEMORY_DATASETS = ("fashion_mnist", "mnist")
+
+
+def to_device_arrays(
+    dataset: torch.utils.data.Dataset, norm_mean: np.ndarray | None = None, norm_std: np.ndarray | None = None
+) -> tuple[jax.Array, jax.Array]:
+    """Applies 'ToTensor' (and optionally 'Normalize') to the whole dataset at once and moves it to device."""
+    x = np.asarray(dataset.data, dtype=np.float32) / 255.0
+    if x.ndim == 3:
+        x = x[..., None]
+    # Channel first: (batch, channel, height, width)
+    x = x.transpose(0, 3, 1, 2)
+    if norm_mean is not None and norm_std is not None:
+        x = (x - norm_mean[None, :, None, None]) / norm_std[None, :, None, None]
+    y = np.asarray(dataset.targets)
+
+    return jax.device_put(x.astype(np.float32)), jax.device_put(y)
+
+
 @dataclass
 class VisionData:
     train_dataset: torch.utils.data.Dataset
@@ -146,7 +314,7 @@ class VisionData:
 
 
 def get_vision_dataloaders(
-    *, dataset_name: str, batch_size: int, should_normalize: bool = False
+    *, dataset_name: str, batch_size: int, should_normalize: bool = False, test_drop_last: bool = True
 ) -> tuple[torch.utils.data.DataLoader, torch.utils.data.DataLoader]:
     if dataset_name not in VISION_DATASETS:
         raise ValueError(f"Dataset {dataset_name} not found in {VISION_DATASETS.keys()}")
@@ -182,14 +350,22 @@ def get_vision_dataloaders(
         ]
     )
 
+    # Identity restore unless the images are normalized.
+    restore_mean, restore_std = np.float32(0.0), np.float32(1.0)
+    if should_normalize:
+        restore_mean = np.asarray(norm_mean, dtype=np.float32)[None, :, None, None]
+        restore_std = np.asarray(norm_std, dtype=np.float32)[None, :, None, None]
+
     def image_restore(x: jnp.ndarray) -> np.ndarray:
         # Channel first: (batch, channel, height, width)
         assert x.shape[1] in (1, 3), f"Expected 1 or 3 channels, got {x.shape[1]}"
-        if should_normalize:
-            x = x * norm_std[None, :, None, None] + norm_mean[None, :, None, None]
+        # Move the whole batch to the host once and do the arithmetic in numpy, rather than dispatching each
+        # elementwise op to the device.
+        x = np.asarray(x, dtype=np.float32)
+        x = x * restore_std + restore_mean
         x = x.clip(0.0, 1.0)
         x = x * 255.0
-        return np.asarray(x, dtype=np.uint8)
+        return x.astype(np.uint8)
 
     train_dataset = ds_cls(
         save_path,
@@ -198,13 +374,6 @@ def get_vision_dataloaders(
         train=True,
     )
 
-    train_dataloader = TorchDataloader(
-        train_dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        num_workers=4,
-    )
-
     test_dataset = ds_cls(
         save_path,
         transform=t,
@@ -212,12 +381,27 @@ def get_vision_dataloaders(
         train=False,
     )
 
-    test_dataloader = TorchDataloader(
-        test_dataset,
-        batch_size=batch_size,
-        shuffle=False,
-        num_workers=4,
-    )
+    if dataset_name in IN_MEMORY_DATASETS:
+        norm = (norm_mean, norm_std) if should_normalize else (None, None)
+        train_dataloader = ArrayDataloader(*to_device_arrays(train_dataset, *norm), batch_size=batch_size, shuffle=True)
+        test_dataloader = ArrayDataloader(
+            *to_device_arrays(test_dataset, *norm), batch_size=batch_size, shuffle=False, drop_last=test_drop_last
+        )
+    else:
+        train_dataloader = TorchDataloader(
+            train_dataset,
+            batch_size=batch_size,
+            shuffle=True,
+            num_workers=4,
+        )
+
+        test_dataloader = TorchDataloader(
+            test_dataset,
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=4,
+            drop_last=test_drop_last,
+        )
 
     return VisionData(
         train_dataset=train_dataset,
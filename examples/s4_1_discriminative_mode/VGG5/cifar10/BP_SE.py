@@ -2,14 +2,27 @@ from typing import Callable
 import torch
 import numpy as np
 import torchvision
-import torchvision.transforms as transforms
 import os
+import sys
+
+# 'seed' must be imported before jax to run the seeds in parallel on multiple GPUs.
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+import seed
 
 # Core dependencies
 import jax
 import jax.numpy as jnp
 import optax
 
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+from data_utils import (
+    ArrayDataset,
+    train_collate,
+    test_collate,
+    normalize,
+    prefetch_to_device,
+)
+
 # pcax
 import pcax as px
 import pcax.nn as pxnn
@@ -115,6 +128,7 @@ class TorchDataloader(torch.utils.data.DataLoader):
         worker_init_fn=None,
         persistent_workers=True,
         prefetch_factor=2,
+        collate_fn=numpy_collate,
     ):
         super(self.__class__, self).__init__(
             dataset,
@@ -123,7 +137,7 @@ class TorchDataloader(torch.utils.data.DataLoader):
             sampler=sampler,
             batch_sampler=batch_sampler,
             num_workers=num_workers,
-            collate_fn=numpy_collate,
+            collate_fn=collate_fn,
             pin_memory=pin_memory,
             drop_last=True if batch_sampler is None else None,
             timeout=timeout,
@@ -133,50 +147,37 @@ class TorchDataloader(torch.utils.data.DataLoader):
         )
 
 
-def get_dataloaders(batch_size: int):
-    t = transforms.Compose([
-        transforms.RandomHorizontalFlip(p=0.5),
-        # transforms.RandomRotation(5),
-        transforms.RandomCrop(32, padding=4),
-        transforms.ToTensor(),
-        # These are normalisation factors found online.
-        transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
-        lambda x: x.numpy()
-    ])
-
-    t_val = transforms.Compose([
-        transforms.ToTensor(),
-        # These are normalisation factors found online.
-        transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
-        lambda x: x.numpy()
-    ])
-
+def get_dataloaders(batch_size: int, num_workers: int = 7, prefetch_factor: int = 4):
+    # Images are kept as raw uint8 arrays and are augmented a whole batch at a time in the collate function, instead
+    # of going through the per-sample PIL/torch transforms. Normalisation happens on device (see 'normalize').
     train_dataset = torchvision.datasets.CIFAR10(
         "~/tmp/cifar10/",
-        transform=t,
         download=False,
         train=True,
     )
 
     train_dataloader = TorchDataloader(
-        train_dataset,
+        ArrayDataset(train_dataset.data, np.asarray(train_dataset.targets)),
         batch_size=batch_size,
         shuffle=True,
-        num_workers=7,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor,
+        collate_fn=train_collate,
     )
 
     test_dataset = torchvision.datasets.CIFAR10(
         "~/tmp/cifar10/",
-        transform=t_val,
         download=False,
         train=False,
     )
 
     test_dataloader = TorchDataloader(
-        test_dataset,
+        ArrayDataset(test_dataset.data, np.asarray(test_dataset.targets)),
         batch_size=batch_size,
         shuffle=False,
-        num_workers=7,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor,
+        collate_fn=test_collate,
     )
 
     return train_dataloader, test_dataloader
@@ -196,6 +197,9 @@ def loss(x, y, *, model: ConvNet):
 @pxf.jit()
 def train_on_batch(x: jax.Array, y: jax.Array, *, model: ConvNet, optim_w: pxu.Optim):
     model.train()
+    # Images are normalised and labels are one-hot encoded on device, fused with the loss.
+    x = normalize(x)
+    y = jax.nn.one_hot(y, model.nm_classes.get())
     # Learning step
     with pxu.step(model):
         _, g = pxf.value_and_grad(pxu.Mask(pxnn.LayerParam, [False, True]), has_aux=True)(loss)(x, y,  model=model)
@@ -205,6 +209,7 @@ def train_on_batch(x: jax.Array, y: jax.Array, *, model: ConvNet, optim_w: pxu.O
 @pxf.jit()
 def eval_on_batch(x: jax.Array, y: jax.Array, *, model: ConvNet):
     model.eval()
+    x = normalize(x)
 
     with pxu.step(model):
         y_ = forward(x, model=model).argmax(axis=-1)
@@ -213,34 +218,42 @@ def eval_on_batch(x: jax.Array, y: jax.Array, *, model: ConvNet):
 
 
 def train(dl, *, model: ConvNet, optim_w: pxu.Optim):
-    for i, (x, y) in enumerate(dl):
-        train_on_batch(
-            x, jax.nn.one_hot(y, model.nm_classes.get()), model=model, optim_w=optim_w
-        )
+    for i, (x, y) in enumerate(prefetch_to_device(dl)):
+        train_on_batch(x, y, model=model, optim_w=optim_w)
 
 
 def eval(dl, *, model: ConvNet):
+    # Results are kept on device and transferred to the host once, so that the loop never blocks on a device to host
+    # copy.
     acc = []
     ys_ = []
 
-    for x, y in dl:
+    for x, y in prefetch_to_device(dl):
         a, y_ = eval_on_batch(x, y, model=model)
         acc.append(a)
         ys_.append(y_)
 
-    return np.mean(acc), np.concatenate(ys_)
+    return float(jnp.stack(acc).mean()), np.asarray(jnp.concatenate(ys_))
 
 
 def main(run_info):
     batch_size = run_info["hp/batch_size"]
     nm_epochs = run_info["hp/epochs"]
 
+    # Precision of the convolutions and matmuls, e.g., 'bfloat16' to run them on the tensor cores of recent GPUs.
+    # Parameters, vodes and optimizer states are still stored in float32. If None, jax's default is used.
+    jax.config.update("jax_default_matmul_precision", run_info["hp/matmul_precision"])
+
     model = ConvNet(
         nm_classes=10, 
         act_fn=getattr(jax.nn, run_info["hp/act_fn"])
     )
     
-    train_dataloader, test_dataloader = get_dataloaders(batch_size)
+    train_dataloader, test_dataloader = get_dataloaders(
+        batch_size,
+        num_workers=run_info["hp/dataloader/num_workers"],
+        prefetch_factor=run_info["hp/dataloader/prefetch_factor"],
+    )
 
     schedule = optax.warmup_cosine_decay_schedule(
         init_value=run_info["hp/optim/w/lr"],
@@ -268,11 +281,18 @@ def main(run_info):
 
 
 if __name__ == "__main__":
-    import os
-    import sys
-    sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
-    import seed
     run_info = seed.RunInfo(
         OmegaConf.load(sys.argv[1])
     )
+    # The config is complete, so the hyperparameters used by 'main' are resolved once and the config is frozen.
+    run_info.lock([
+        "hp/act_fn",
+        "hp/batch_size",
+        "hp/dataloader/num_workers",
+        "hp/dataloader/prefetch_factor",
+        "hp/epochs",
+        "hp/matmul_precision",
+        "hp/optim/w/lr",
+        "hp/optim/w/wd",
+    ])
     seed.run(main)(run_info)
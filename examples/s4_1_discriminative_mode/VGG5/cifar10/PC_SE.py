@@ -2,14 +2,27 @@ from typing import Callable
 import torch
 import numpy as np
 import torchvision
-import torchvision.transforms as transforms
+import os
+import sys
 
+# 'seed' must be imported before jax to run the seeds in parallel on multiple GPUs.
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+import seed
 
 # Core dependencies
 import jax
 import jax.numpy as jnp
 import optax
 
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+from data_utils import (
+    ArrayDataset,
+    train_collate,
+    test_collate,
+    normalize,
+    prefetch_to_device,
+)
+
 # pcax
 import pcax as px
 import pcax.predictive_coding as pxc
@@ -122,6 +135,7 @@ class TorchDataloader(torch.utils.data.DataLoader):
         worker_init_fn=None,
         persistent_workers=True,
         prefetch_factor=2,
+        collate_fn=numpy_collate,
     ):
         super(self.__class__, self).__init__(
             dataset,
@@ -130,7 +144,7 @@ class TorchDataloader(torch.utils.data.DataLoader):
             sampler=sampler,
             batch_sampler=batch_sampler,
             num_workers=num_workers,
-            collate_fn=numpy_collate,
+            collate_fn=collate_fn,
             pin_memory=pin_memory,
             drop_last=True if batch_sampler is None else None,
             timeout=timeout,
@@ -140,50 +154,37 @@ class TorchDataloader(torch.utils.data.DataLoader):
         )
 
 
-def get_dataloaders(batch_size: int):
-    t = transforms.Compose([
-        transforms.RandomHorizontalFlip(p=0.5),
-        # transforms.RandomRotation(5),
-        transforms.RandomCrop(32, padding=4),
-        transforms.ToTensor(),
-        # These are normalisation factors found online.
-        transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
-        lambda x: x.numpy()
-    ])
-
-    t_val = transforms.Compose([
-        transforms.ToTensor(),
-        # These are normalisation factors found online.
-        transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
-        lambda x: x.numpy()
-    ])
-
+def get_dataloaders(batch_size: int, num_workers: int = 8, prefetch_factor: int = 4):
+    # Images are kept as raw uint8 arrays and are augmented a whole batch at a time in the collate function, instead
+    # of going through the per-sample PIL/torch transforms. Normalisation happens on device (see 'normalize').
     train_dataset = torchvision.datasets.CIFAR10(
         "~/tmp/cifar10/",
-        transform=t,
         download=True,
         train=True,
     )
 
     train_dataloader = TorchDataloader(
-        train_dataset,
+        ArrayDataset(train_dataset.data, np.asarray(train_dataset.targets)),
         batch_size=batch_size,
         shuffle=True,
-        num_workers=8,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor,
+        collate_fn=train_collate,
     )
 
     test_dataset = torchvision.datasets.CIFAR10(
         "~/tmp/cifar10/",
-        transform=t_val,
         download=True,
         train=False,
     )
 
     test_dataloader = TorchDataloader(
-        test_dataset,
+        ArrayDataset(test_dataset.data, np.asarray(test_dataset.targets)),
         batch_size=batch_size,
         shuffle=False,
-        num_workers=8,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor,
+        collate_fn=test_collate,
     )
 
     return train_dataloader, test_dataloader
@@ -200,34 +201,52 @@ def energy(x, *, model: ConvNet):
     return jax.lax.pmean(model.energy().sum(), "batch"), y_
 
 
+# Built once, rather than every time 'train_on_batch' is traced.
+trainable_vode_params = pxu.m(pxc.VodeParam).has_not(frozen=True)
+trainable_vodes = pxu.Mask(trainable_vode_params)
+
+inference_step = pxf.value_and_grad(pxu.Mask(trainable_vode_params, [False, True]), has_aux=True)(energy)
+
+learning_step = pxf.value_and_grad(pxu.Mask(pxnn.LayerParam, [False, True]), has_aux=True)(energy)
+
+
+def h_step(i, x: jax.Array, *, model: ConvNet, optim_h: pxu.Optim):
+    with pxu.step(model, clear_params=pxc.VodeParam.Cache):
+        _, g = inference_step(x, model=model)
+
+    optim_h.step(model, g["model"], True)
+
+    return x, None
+
+
 @pxf.jit(static_argnums=0)
 def train_on_batch(T: int, x: jax.Array, y: jax.Array, *, model: ConvNet, optim_w: pxu.Optim, optim_h: pxu.Optim, beta: float = 1.0):
     model.train()
+    # Images are normalised and labels are one-hot encoded on device, fused with the target vode update.
+    x = normalize(x)
+    y = jax.nn.one_hot(y, model.nm_classes.get())
 
     # Init step
     with pxu.step(model, pxc.STATUS.INIT, clear_params=pxc.VodeParam.Cache):
         forward(x, y, model=model, beta=beta)
-    optim_h.init(pxu.Mask(pxc.VodeParam)(model))
-
-    # Inference steps
-    for _ in range(T):
-        with pxu.step(model, clear_params=pxc.VodeParam.Cache):
-            _, g = pxf.value_and_grad(pxu.Mask(pxu.m(pxc.VodeParam).has_not(frozen=True), [False, True]), has_aux=True)(
-                energy
-            )(x, model=model)
+    # The frozen output vode never receives a gradient, so it is excluded from the optimizer state to keep its
+    # structure constant across the scanned inference steps.
+    optim_h.init(trainable_vodes(model))
 
-        optim_h.step(model, g["model"], True)
+    # Inference steps: the loop is traced once by 'scan' instead of being unrolled T times.
+    pxf.scan(h_step, xs=jnp.arange(T))(x, model=model, optim_h=optim_h)
     optim_h.clear()
 
     # Learning step
     with pxu.step(model, clear_params=pxc.VodeParam.Cache):
-        _, g = pxf.value_and_grad(pxu.Mask(pxnn.LayerParam, [False, True]), has_aux=True)(energy)(x, model=model)
+        _, g = learning_step(x, model=model)
     optim_w.step(model, g["model"], mul=1/beta)
 
 
 @pxf.jit()
 def eval_on_batch(x: jax.Array, y: jax.Array, *, model: ConvNet):
     model.eval()
+    x = normalize(x)
 
     with pxu.step(model, pxc.STATUS.INIT, clear_params=pxc.VodeParam.Cache):
         y_ = forward(x, None, model=model).argmax(axis=-1)
@@ -236,33 +255,41 @@ def eval_on_batch(x: jax.Array, y: jax.Array, *, model: ConvNet):
 
 
 def train(dl, T, *, model: ConvNet, optim_w: pxu.Optim, optim_h: pxu.Optim, beta: float = 1.0):
-    for i, (x, y) in enumerate(dl):
-        train_on_batch(
-            T, x, jax.nn.one_hot(y, model.nm_classes.get()), model=model, optim_w=optim_w, optim_h=optim_h, beta=beta
-        )
+    for i, (x, y) in enumerate(prefetch_to_device(dl)):
+        train_on_batch(T, x, y, model=model, optim_w=optim_w, optim_h=optim_h, beta=beta)
 
 
 def eval(dl, *, model: ConvNet):
+    # Results are kept on device and transferred to the host once, so that the loop never blocks on a device to host
+    # copy.
     acc = []
     ys_ = []
 
-    for x, y in dl:
+    for x, y in prefetch_to_device(dl):
         a, y_ = eval_on_batch(x, y, model=model)
         acc.append(a)
         ys_.append(y_)
 
-    return np.mean(acc), np.concatenate(ys_)
+    return float(jnp.stack(acc).mean()), np.asarray(jnp.concatenate(ys_))
 
 
 def main(run_info):
     batch_size = run_info["hp/batch_size"]
     nm_epochs = run_info["hp/epochs"]
 
+    # Precision of the convolutions and matmuls, e.g., 'bfloat16' to run them on the tensor cores of recent GPUs.
+    # Parameters, vodes and optimizer states are still stored in float32. If None, jax's default is used.
+    jax.config.update("jax_default_matmul_precision", run_info["hp/matmul_precision"])
+
     model = ConvNet(
         nm_classes=10, 
         act_fn=getattr(jax.nn, run_info["hp/act_fn"]))
     
-    train_dataloader, test_dataloader = get_dataloaders(batch_size)
+    train_dataloader, test_dataloader = get_dataloaders(
+        batch_size,
+        num_workers=run_info["hp/dataloader/num_workers"],
+        prefetch_factor=run_info["hp/dataloader/prefetch_factor"],
+    )
 
     with pxu.step(model, pxc.STATUS.INIT, clear_params=pxc.VodeParam.Cache):
         forward(jnp.zeros((batch_size, 3, 32, 32)), None, model=model)
@@ -284,13 +311,16 @@ def main(run_info):
         optim_w = pxu.Optim(optax.adamw(schedule,weight_decay=run_info["hp/optim/w/wd"]), pxu.Mask(pxnn.LayerParam)(model))
     
     
+    T = run_info["hp/T"]
+    beta_factor, beta_0, beta_ir = run_info["hp/beta_factor"], run_info["hp/beta"], run_info["hp/beta_ir"]
+
     best_accuracy = 0
     accuracies = []
     for e in range(nm_epochs):
-        beta = run_info["hp/beta_factor"] * (run_info["hp/beta"] + run_info["hp/beta_ir"]*e)
+        beta = beta_factor * (beta_0 + beta_ir*e)
         if abs(beta) >= 1.0:
             beta = 1.0
-        train(train_dataloader, T=run_info["hp/T"], model=model, optim_w=optim_w, optim_h=optim_h, beta=beta)
+        train(train_dataloader, T=T, model=model, optim_w=optim_w, optim_h=optim_h, beta=beta)
         a, y = eval(test_dataloader, model=model)
         accuracies.append(float(a))
         
@@ -305,11 +335,24 @@ def main(run_info):
 
 
 if __name__ == "__main__":
-    import os
-    import sys
-    sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
-    import seed
     run_info = seed.RunInfo(
         OmegaConf.load(sys.argv[1])
     )
+    # The config is complete, so the hyperparameters used by 'main' are resolved once and the config is frozen.
+    run_info.lock([
+        "hp/T",
+        "hp/act_fn",
+        "hp/batch_size",
+        "hp/beta",
+        "hp/beta_factor",
+        "hp/beta_ir",
+        "hp/dataloader/num_workers",
+        "hp/dataloader/prefetch_factor",
+        "hp/epochs",
+        "hp/matmul_precision",
+        "hp/optim/w/lr",
+        "hp/optim/w/wd",
+        "hp/optim/x/lr",
+        "hp/optim/x/momentum",
+    ])
     seed.run(main)(run_info)
@@ -1,6 +1,5 @@
 import torch
 import numpy
-import pcax
 import random
 
 import os
@@ -12,6 +11,21 @@ from typing import Any, Optional, List
 import omegaconf
 from omegaconf import OmegaConf
 
+try:
+    import ray
+except ImportError:
+    ray = None
+
+# If ray is available and there are multiple GPUs, the seeds are run in parallel, one per GPU. Importing pcax
+# initialises jax, which by default preallocates most of the memory of every visible GPU, leaving none for the ray
+# workers. So preallocation is disabled in this process, which is only possible if jax has not been imported yet
+# (i.e., if this module is imported first). Otherwise, the seeds are run serially.
+PARALLEL_SEEDS = ray is not None and torch.cuda.device_count() > 1 and "jax" not in sys.modules
+if PARALLEL_SEEDS:
+    os.environ["XLA_PYTHON_CLIENT_PREALLOCATE"] = "false"
+
+import pcax
+
 SEEDS = [0, 1, 2, 3, 4, 5, 6]
 
 class RunInfo:
@@ -26,6 +40,9 @@ class RunInfo:
         self.log = log or {}
         self.locked = False
 
+        self._register_resolvers()
+
+    def _register_resolvers(self) -> None:
         OmegaConf.register_new_resolver(
             "py", lambda code: eval(code.strip()), replace=True
         )
@@ -33,6 +50,12 @@ class RunInfo:
             "hp", lambda param: self[f"hp/{param}"], replace=True
         )
 
+    def __setstate__(self, state) -> None:
+        # Resolvers are global to OmegaConf, so they must be registered again when
+        # unpickled in another process (e.g., a ray worker).
+        self.__dict__.update(state)
+        self._register_resolvers()
+
     def __getitem__(self, i: Any) -> Any:
         if i in self.log:
             return self.log[i]
@@ -69,23 +92,39 @@ class RunInfo:
         for p in to_load:
             self.__getitem__(p)
 
+        # Once locked, only the loaded parameters can be accessed, so their interpolations are resolved once and
+        # containers are converted to plain python objects, to avoid going through omegaconf on every access.
+        for p, v in self.log.items():
+            if isinstance(v, omegaconf.Container):
+                self.log[p] = OmegaConf.to_container(v, resolve=True)
+        OmegaConf.set_readonly(self.config, True)
+
         self.locked = True
 
 
+def run_seed(fn, seed, *args, **kwargs):
+    torch.manual_seed(seed)
+    numpy.random.seed(seed)
+    random.seed(seed)
+    pcax.RKG.seed(seed)
+
+    return fn(*args, **kwargs)
+
+
 class run:
     def __init__(self, fn):
         self._seeds = SEEDS
 
         def wrap_fn(*args, **kwargs):
+            if PARALLEL_SEEDS:
+                run_seed_remote = ray.remote(num_gpus=1)(run_seed)
+                results = ray.get([run_seed_remote.remote(fn, seed, *args, **kwargs) for seed in self._seeds])
+            else:
+                results = (run_seed(fn, seed, *args, **kwargs) for seed in self._seeds)
+
             best_per_seed = []
             accuracies_per_seed = []
-            for seed in self._seeds:
-                torch.manual_seed(seed)
-                numpy.random.seed(seed)
-                random.seed(seed)
-                pcax.RKG.seed(seed)
-                
-                best, accuracies = fn(*args, **kwargs)
+            for best, accuracies in results:
                 print(best)
                 best_per_seed.append(best)
                 accuracies_per_seed.append(accuracies)
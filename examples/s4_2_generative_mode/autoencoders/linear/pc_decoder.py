@@ -7,23 +7,33 @@ import argparse
 # Core dependencies
 import jax
 import jax.numpy as jnp
+from jax.sharding import Mesh, NamedSharding, PartitionSpec
 import numpy as np
 import optax
 from omegaconf import OmegaConf
 
-# pcax
-import pcax as px
-import pcax.predictive_coding as pxc
-import pcax.nn as pxnn
-import pcax.utils as pxu
-import pcax.functional as pxf
-from pcax import RKG
-
 sys.path.insert(0, "../../../")
-from data_utils import get_vision_dataloaders, reconstruct_image, seed_everything, get_config_value  # noqa: E402
+from data_utils import (  # noqa: E402
+    get_vision_dataloaders,
+    reconstruct_image,
+    seed_everything,
+    get_config_value,
+    prefetch_to_device,
+    enable_compilation_cache,
+)
 
 sys.path.pop(0)
 
+enable_compilation_cache()
+
+# pcax
+import pcax as px  # noqa: E402
+import pcax.predictive_coding as pxc  # noqa: E402
+import pcax.nn as pxnn  # noqa: E402
+import pcax.utils as pxu  # noqa: E402
+import pcax.functional as pxf  # noqa: E402
+from pcax import RKG  # noqa: E402
+
 
 def seed_pcax_and_everything(seed: int | None = None):
     if seed is None:
@@ -167,28 +177,48 @@ def energy(example: jax.Array, *, model: PCDecoder) -> jax.Array:
     return jax.lax.pmean(model.energy().sum(), "batch"), y_
 
 
-@pxf.jit(static_argnums=0)
-def train_on_batch_pc(T: int, examples: jax.Array, *, model: PCDecoder, optim_w: pxu.Optim, optim_h: pxu.Optim):
-    model.train()
+# Shared by the PC and iPC train steps, so each is built once instead of at every trace.
+trainable_vode_params = pxu.m(pxc.VodeParam).has_not(frozen=True)
+trainable_vodes = pxu.Mask(trainable_vode_params)
+
+inference_step = pxf.value_and_grad(pxu.Mask(trainable_vode_params, [False, True]), has_aux=True)(energy)
+
+learning_step = pxf.value_and_grad(pxu.Mask(pxnn.LayerParam, [False, True]), has_aux=True)(energy)
+
+ipc_step = pxf.value_and_grad(
+    pxu.Mask(trainable_vode_params | pxu.m(pxnn.LayerParam), [False, True]), has_aux=True
+)(energy)
+
+
+def h_step(i, examples, *, model: PCDecoder, optim_h: pxu.Optim):
+    with pxu.step(model, clear_params=pxc.VodeParam.Cache):
+        (e, _), g = inference_step(examples, model=model)
 
-    inference_step = pxf.value_and_grad(
-        pxu.Mask(pxu.m(pxc.VodeParam).has_not(frozen=True), [False, True]), has_aux=True
-    )(energy)
+    optim_h.step(model, g["model"], scale_by_batch_size=True)
+    return examples, e
 
-    learning_step = pxf.value_and_grad(pxu.Mask(pxnn.LayerParam, [False, True]), has_aux=True)(energy)
+
+def ipc_h_step(i, examples, *, model: PCDecoder, optim_w: pxu.Optim, optim_h: pxu.Optim):
+    with pxu.step(model, clear_params=pxc.VodeParam.Cache):
+        (e, _), g = ipc_step(examples, model=model)
+
+    optim_h.step(model, g["model"], scale_by_batch_size=True)
+    optim_w.step(model, g["model"])
+    return examples, e
+
+
+@pxf.jit(static_argnums=0, donate_argnames=("model", "optim_w", "optim_h"))
+def train_on_batch_pc(T: int, examples: jax.Array, *, model: PCDecoder, optim_w: pxu.Optim, optim_h: pxu.Optim):
+    model.train()
 
     # Init step
     with pxu.step(model, pxc.STATUS.INIT, clear_params=pxc.VodeParam.Cache):
         forward(examples, model=model)
 
-    optim_h.init(pxu.Mask(pxc.VodeParam)(model))
+    optim_h.init(trainable_vodes(model))
 
     # Inference steps
-    for _ in range(T):
-        with pxu.step(model, clear_params=pxc.VodeParam.Cache):
-            _, g = inference_step(examples, model=model)
-
-        optim_h.step(model, g["model"], scale_by_batch_size=True)
+    _, energies = pxf.scan(h_step, xs=jnp.arange(T))(examples, model=model, optim_h=optim_h)
 
     optim_h.clear()
 
@@ -197,51 +227,42 @@ def train_on_batch_pc(T: int, examples: jax.Array, *, model: PCDecoder, optim_w:
         _, g = learning_step(examples, model=model)
     optim_w.step(model, g["model"])
 
+    return energies
 
-@pxf.jit(static_argnums=0)
+
+@pxf.jit(static_argnums=0, donate_argnames=("model", "optim_w", "optim_h"))
 def train_on_batch_ipc(T: int, examples: jax.Array, *, model: PCDecoder, optim_w: pxu.Optim, optim_h: pxu.Optim):
     model.train()
 
-    step = pxf.value_and_grad(
-        pxu.Mask(pxu.m(pxc.VodeParam).has_not(frozen=True) | pxu.m(pxnn.LayerParam), [False, True]), has_aux=True
-    )(energy)
-
     # Init step
     with pxu.step(model, pxc.STATUS.INIT, clear_params=pxc.VodeParam.Cache):
         forward(examples, model=model)
 
-    optim_h.init(pxu.Mask(pxc.VodeParam)(model))
+    optim_h.init(trainable_vodes(model))
 
     # Inference steps
-    for _ in range(T):
-        with pxu.step(model, clear_params=pxc.VodeParam.Cache):
-            _, g = step(examples, model=model)
-
-        optim_h.step(model, g["model"], scale_by_batch_size=True)
-        optim_w.step(model, g["model"])
+    _, energies = pxf.scan(ipc_h_step, xs=jnp.arange(T))(
+        examples, model=model, optim_w=optim_w, optim_h=optim_h
+    )
     optim_h.clear()
 
+    return energies
+
 
 @pxf.jit(static_argnums=0)
 def generate_on_batch(T: int, examples: jax.Array, *, model: PCDecoder, optim_h: pxu.Optim):
     model.eval()
 
-    inference_step = pxf.value_and_grad(
-        pxu.Mask(pxu.m(pxc.VodeParam).has_not(frozen=True), [False, True]), has_aux=True
-    )(energy)
-
     # Init step
     with pxu.step(model, pxc.STATUS.INIT, clear_params=pxc.VodeParam.Cache):
         forward(examples, model=model)
 
-    optim_h.init(pxu.Mask(pxc.VodeParam)(model))
-
-    # Inference steps
-    for _ in range(T):
-        with pxu.step(model, clear_params=pxc.VodeParam.Cache):
-            _, g = inference_step(examples, model=model)
+    # Frozen vodes never receive a gradient, so they are excluded from the optimizer state to keep its structure
+    # constant across the scanned inference steps.
+    optim_h.init(trainable_vodes(model))
 
-        optim_h.step(model, g["model"], scale_by_batch_size=True)
+    # Inference steps: the loop is traced once by 'scan' instead of being unrolled T times.
+    pxf.scan(h_step, xs=jnp.arange(T))(examples, model=model, optim_h=optim_h)
     optim_h.clear()
     pred = generate(model.internal_state, model=model)
 
@@ -266,38 +287,88 @@ def generate_on_batch(T: int, examples: jax.Array, *, model: PCDecoder, optim_h:
 
 
 @pxf.jit(static_argnums=0)
-def eval_on_batch(T: int, examples: jax.Array, *, model: PCDecoder, optim_h: pxu.Optim):
+def eval_on_batch(T: int, examples: jax.Array, mask: jax.Array, *, model: PCDecoder, optim_h: pxu.Optim):
     pred = generate_on_batch(T, examples, model=model, optim_h=optim_h)
 
-    mse_loss = jnp.square(pred.flatten() - examples.flatten()).mean()
+    # Padding examples (mask == False) are excluded from the loss.
+    mse_loss = (jnp.square(pred - examples).mean(axis=1) * mask).sum() / mask.sum()
 
     return mse_loss, pred
 
 
-def train(dl, T, *, model: PCDecoder, optim_w: pxu.Optim, optim_h: pxu.Optim, batch_size: int, use_ipc: bool = False):
-    for x, y in dl:
+def data_parallel_shardings(batch_size: int) -> tuple[NamedSharding, NamedSharding] | None:
+    """Returns the shardings to split each batch across the local devices and to replicate the model state on all of
+    them. The jitted functions are then partitioned by XLA to run data parallel, with the gradient reductions over the
+    batch becoming cross-device collectives. Returns None if there is a single device or the batch cannot be split
+    evenly.
+    """
+    devices = jax.local_devices()
+    if len(devices) == 1 or batch_size % len(devices) != 0:
+        return None
+
+    mesh = Mesh(np.array(devices), ("batch",))
+    return NamedSharding(mesh, PartitionSpec("batch")), NamedSharding(mesh, PartitionSpec())
+
+
+def replicate(sharding: NamedSharding, *modules) -> None:
+    px.tree_apply(
+        lambda p: p.set(jax.device_put(p.get(), sharding)),
+        lambda x: isinstance(x, px.Param | px.ParamDict),
+        tree=modules,
+        recursive=False,
+    )
+
+
+def train(
+    dl,
+    T,
+    *,
+    model: PCDecoder,
+    optim_w: pxu.Optim,
+    optim_h: pxu.Optim,
+    batch_size: int,
+    use_ipc: bool = False,
+    batch_sharding: NamedSharding | None = None,
+):
+    # Energies are kept on device and transferred to the host once at the end of the epoch, so that the loop never
+    # blocks on a device to host copy.
+    energies = []
+
+    for x, y in prefetch_to_device(dl, sharding=batch_sharding):
         if x.shape[0] != batch_size:
             logging.warning(f"Skipping batch of size {x.shape[0]} that's not equal to the batch size {batch_size}.")
             continue
         x = x.reshape(x.shape[0], -1)
         if use_ipc:
-            train_on_batch_ipc(T, x, model=model, optim_w=optim_w, optim_h=optim_h)
+            e = train_on_batch_ipc(T, x, model=model, optim_w=optim_w, optim_h=optim_h)
         else:
-            train_on_batch_pc(T, x, model=model, optim_w=optim_w, optim_h=optim_h)
+            e = train_on_batch_pc(T, x, model=model, optim_w=optim_w, optim_h=optim_h)
+        energies.append(e)
 
+    return np.asarray(jnp.stack(energies)) if energies else np.empty((0, T))
 
-def eval(dl, T, *, model: PCDecoder, optim_h: pxu.Optim, batch_size: int):
-    losses = []
 
-    for x, y in dl:
-        if x.shape[0] != batch_size:
-            logging.warning(f"Skipping batch of size {x.shape[0]} that's not equal to the batch size {batch_size}.")
-            continue
-        x = x.reshape(x.shape[0], -1)
-        e, y_hat = eval_on_batch(T, x, model=model, optim_h=optim_h)
-        losses.append(e)
-
-    return np.mean(losses)
+def eval(dl, T, *, model: PCDecoder, optim_h: pxu.Optim, batch_size: int, batch_sharding: NamedSharding | None = None):
+    losses = []
+    num_examples = 0
+
+    # The last batch may be incomplete, so it is sharded only after being padded.
+    for x, y in prefetch_to_device(dl):
+        n = x.shape[0]
+        x = x.reshape(n, -1)
+        if n != batch_size:
+            # Pad the last incomplete batch to the batch size, so that it runs with the same compiled function and
+            # every test example is evaluated. Inference is independent for each example, so padding does not
+            # affect the others.
+            x = jnp.pad(x, ((0, batch_size - n), (0, 0)))
+        mask = np.arange(batch_size) < n
+        if batch_sharding is not None:
+            x = jax.device_put(x, batch_sharding)
+        e, y_hat = eval_on_batch(T, x, mask, model=model, optim_h=optim_h)
+        losses.append(e * n)
+        num_examples += n
+
+    return float(jnp.stack(losses).sum() / num_examples) if losses else np.nan
 
 
 def run_experiment(
@@ -326,7 +397,9 @@ def run_experiment(
     if checkpoint_dir is not None:
         checkpoint_dir.mkdir(parents=True, exist_ok=True)
 
-    dataset = get_vision_dataloaders(dataset_name=dataset_name, batch_size=batch_size, should_normalize=False)
+    dataset = get_vision_dataloaders(
+        dataset_name=dataset_name, batch_size=batch_size, should_normalize=False, test_drop_last=False
+    )
 
     output_dim = layer_dims[-1]
 
@@ -352,6 +425,12 @@ def run_experiment(
     else:
         raise ValueError(f"Unknown optimizer name: {optim_w_name}")
 
+    batch_sharding = None
+    if (shardings := data_parallel_shardings(batch_size)) is not None:
+        batch_sharding, replicated_sharding = shardings
+        replicate(replicated_sharding, model, optim_w, optim_h)
+        logging.info(f"Splitting each batch across {jax.local_device_count()} devices.")
+
     # if len(dataset.train_dataset) % batch_size != 0 or len(dataset.test_dataset) % batch_size != 0:
     #     raise ValueError("The dataset size must be divisible by the batch size.")
 
@@ -365,7 +444,7 @@ def run_experiment(
     best_loss: float | None = None
     test_losses: list[float] = []
     for epoch in range(epochs):
-        train(
+        train_energies = train(
             dataset.train_dataloader,
             T=T,
             model=model,
@@ -373,8 +452,16 @@ def run_experiment(
             optim_h=optim_h,
             batch_size=batch_size,
             use_ipc=use_ipc,
+            batch_sharding=batch_sharding,
+        )
+        mse_loss = eval(
+            dataset.test_dataloader,
+            T=T,
+            model=model,
+            optim_h=optim_h,
+            batch_size=batch_size,
+            batch_sharding=batch_sharding,
         )
-        mse_loss = eval(dataset.test_dataloader, T=T, model=model, optim_h=optim_h, batch_size=batch_size)
         if np.isnan(mse_loss):
             logging.warning("Model diverged. Stopping training.")
             break
@@ -383,7 +470,9 @@ def run_experiment(
             best_loss = mse_loss
             pxu.save_params(model, str(model_save_dir / "model"))
             model_saved = True
-        print(f"Epoch {epoch + 1}/{epochs} - Test Loss: {mse_loss:.4f}")
+        print(
+            f"Epoch {epoch + 1}/{epochs} - Train Energy: {train_energies[:, -1].mean():.4f} - Test Loss: {mse_loss:.4f}"
+        )
 
     if model_saved:
         pxu.load_params(model, str(model_save_dir / "model"))
@@ -272,6 +272,9 @@ class Param(DynamicParam):
         return self._value.__array__(dtype)
 
     def __getattr__(self, __name):
+        # '_value' is not set yet while unpickling, so it must not be looked up on itself.
+        if __name == "_value":
+            raise AttributeError(__name)
         return getattr(self._value, __name)
 
     @property
@@ -90,6 +90,9 @@ class StaticParam(BaseParam):
 
     def __getattr__(self, __name: str) -> Any:
         """Overloads __getattr__ to return the attribute of the static value."""
+        # '_static_value' is not set yet while unpickling, so it must not be looked up on itself.
+        if __name == "_static_value":
+            raise AttributeError(__name)
         return getattr(self._static_value, __name)
 
     def __contains__(self, __key: str) -> bool:
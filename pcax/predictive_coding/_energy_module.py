@@ -1,7 +1,6 @@
 __all__ = []
 
 from typing import Any, Callable, Type
-import functools
 from types import UnionType
 
 import jax
@@ -37,15 +36,20 @@ class EnergyModule(Module):
 
     def energy(self) -> jax.Array:
         """Return the total energy of the module as the recursive sum of all the energies of its submodules.
-        Note that differently from the Vodes, the energy is not cached.
+        Note that differently from the Vodes, the energy is not cached. A module without any energy submodule has
+        zero energy.
         
         Returns:
             jax.Array: total energy of the module.
         """
-        return functools.reduce(
-            lambda x, y: x + y,
-            (m.energy() for m in self.submodules(cls=EnergyModule))
-        )
+        _energies = [m.energy() for m in self.submodules(cls=EnergyModule)]
+        if not _energies:
+            return jax.numpy.zeros(())
+
+        # A single reduction over the stacked energies, instead of a chain of additions, keeps the traced graph small.
+        # Energies are broadcast first, as they may have different shapes (e.g., the scalar zero energy of a module
+        # without vodes next to the batched energies of the vodes, outside of vmap).
+        return jax.numpy.stack(jax.numpy.broadcast_arrays(*_energies)).sum(axis=0)
     
     def clear_params(self, filter: Callable[[Any], bool] | Type) -> None:
         """Set the selected parameters to None. This is especially useful to clear the cache of the parameters when needed.
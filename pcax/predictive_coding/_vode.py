@@ -6,6 +6,7 @@ __all__ = [
 
 import jax
 from typing import Callable, Any, Tuple, Dict, Sequence
+import functools
 import re
 
 from ..core._random import RKG, RandomKeyGenerator
@@ -28,6 +29,37 @@ from ._energy import se_energy
 #
 ########################################################################################################################
 
+# Utils ################################################################################################################
+
+
+@functools.lru_cache(maxsize=1024)
+def _filter_rules(
+    rules: Tuple[Tuple[str, Tuple[str, ...]], ...], status: str, rule_pattern: str
+) -> Tuple[Tuple[str, str], ...]:
+    """Matches the rules against the given status and rule pattern. Since rules are static, the result only depends
+    on the (hashable) input values and is cached, avoiding to re-run the regular expressions every time a Vode is
+    accessed.
+
+    Args:
+        rules (Tuple[Tuple[str, Tuple[str, ...]], ...]): the (status pattern, rules) pairs of a ruleset.
+        status (str): the target status to match.
+        rule_pattern (str): the target rule pattern to match.
+
+    Returns:
+        Tuple[Tuple[str, str], ...]: the target and transformation of each matched rule.
+    """
+    _matches = []
+    for _pattern, _rules in rules:
+        if re.match(_pattern, status) is None:
+            continue
+
+        for _rule in _rules:
+            if _match := re.match(rule_pattern, _rule):
+                _matches.append(_match.group(1, 2))
+
+    return tuple(_matches)
+
+
 # Core #################################################################################################################
 
 
@@ -83,14 +115,9 @@ class Ruleset(BaseModule):
             Tuple[str, str]: the target and transformation of the rule.
         """
         status = status or ""
+        _rules = tuple((_pattern, tuple(_rules)) for _pattern, _rules in self.rules.items())
 
-        for _pattern, _rules in self.rules.items():
-            if re.match(_pattern, status) is None:
-                continue
-
-            for _rule in _rules:
-                if _match := re.match(rule_pattern, _rule):
-                    yield _match.group(1, 2)
+        yield from _filter_rules(_rules, status, rule_pattern)
 
     def apply_set_transformation(
         self, node: "Vode", tform: str, key: str, value: Any | None = None, rkg: RandomKeyGenerator = RKG
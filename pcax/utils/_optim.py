@@ -28,6 +28,16 @@ from ..core._static import static
 ########################################################################################################################
 
 
+# Utils ################################################################################################################
+
+
+def _is_param(x) -> bool:
+    return isinstance(x, BaseParam)
+
+
+# Core #################################################################################################################
+
+
 class Optim(BaseModule):
     """Optim inherits from core.BaseModule and thus it is a pytree. It is a thin wrapper around the optax library."""
 
@@ -65,24 +75,25 @@ class Optim(BaseModule):
         # parameters structure.
         # For example 'grads' could contain gradients computed for parameters not targeted by this optimiser without
         # causing any issue since they will be filtered out automatically.
-        module = eqx.filter(module, self.filter.get(), is_leaf=lambda x: isinstance(x, BaseParam))
+        _filter = self.filter.get()
+        module = eqx.filter(module, _filter, is_leaf=_is_param)
 
         if scale_by_batch_size is True:
             grads = jtu.tree_map(
                 lambda x, f: x.set(x * x.shape[0]) if f is True else None,
                 grads,
-                self.filter.get(),
-                is_leaf=lambda x: isinstance(x, BaseParam),
+                _filter,
+                is_leaf=_is_param,
             )
         elif mul is not None:
             grads = jtu.tree_map(
                 lambda x, f: x.set(x * mul) if f is True else None,
                 grads,
-                self.filter.get(),
-                is_leaf=lambda x: isinstance(x, BaseParam),
+                _filter,
+                is_leaf=_is_param,
             )
         else:
-            grads = eqx.filter(grads, self.filter.get(), is_leaf=lambda x: isinstance(x, BaseParam))
+            grads = eqx.filter(grads, _filter, is_leaf=_is_param)
 
         updates, state = self.optax_opt.update(
             grads,
@@ -108,17 +119,15 @@ class Optim(BaseModule):
             lambda u, p: set(p, eqx.apply_updates(get(p), get(u))),
             updates,
             module,
-            is_leaf=lambda x: isinstance(x, BaseParam),
+            is_leaf=_is_param,
         )
 
     def init(self, parameters: PyTree) -> None:
         # We compute a static filter identifying the parameters given to be optimised. This is useful to filter out
         # he remaining parameters and allow them to change structure without affecting the functioning of the
         # optimizer.
-        self.filter.set(
-            jtu.tree_map(lambda x: get(x) is not None, parameters, is_leaf=lambda x: isinstance(x, BaseParam))
-        )
-        parameters = eqx.filter(parameters, self.filter.get(), is_leaf=lambda x: isinstance(x, BaseParam))
+        self.filter.set(jtu.tree_map(lambda x: get(x) is not None, parameters, is_leaf=_is_param))
+        parameters = eqx.filter(parameters, self.filter.get(), is_leaf=_is_param)
 
         self.state.set(self.optax_opt.init(parameters))
 
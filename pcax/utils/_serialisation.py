@@ -25,7 +25,8 @@ from ..nn._parameter import LayerParam
 def save_params(
     model: PyTree,
     path: str,
-    filter: Callable[[Any], bool] | Type[BaseParam] = LayerParam
+    filter: Callable[[Any], bool] | Type[BaseParam] = LayerParam,
+    dtype: jax.typing.DTypeLike | None = None
 ) -> None:
     """Function to save the parameters of a model to a file. The '.npz' extension is automatically added
     to the file name.
@@ -37,6 +38,9 @@ def save_params(
         filter (Callable[[Any], bool] | Type[BaseParam], optional): filter function or type identifying
             the parameters to save. The default value 'LayerParam' selects all the weights of the layers in the
             model.
+        dtype (jax.typing.DTypeLike | None, optional): if specified, floating point values are cast to this
+            dtype before being saved (e.g., 'jax.numpy.bfloat16' to halve the file size). 'load_params' casts
+            them back to the dtype of the target parameters.
     """
     _filter_fn = (filter 
         if not isinstance(filter, type | UnionType)
@@ -58,7 +62,14 @@ def save_params(
             else:
                 _data[jtu.keystr(key)] = None
 
-    np.savez_compressed(path, **_data)
+    if dtype is not None:
+        _data = jtu.tree_map(
+            lambda x: x.astype(dtype) if jax.numpy.issubdtype(x.dtype, jax.numpy.floating) else x,
+            _data
+        )
+
+    # Transfer all the values to the host at once, instead of one array at a time.
+    np.savez_compressed(path, **jax.device_get(_data))
 
 
 def load_params(
@@ -96,12 +107,25 @@ def load_params(
         is_leaf=_filter_fn
     )[0]
     
+    _targets = []
+    _values = []
     for _key, _param in _params:
         if _filter_fn(_param):
             _key = jtu.keystr(_key)
             if _key not in _loaded_values:
                 raise KeyError(f"Parameter '{_key}' not found in the file '{path}'.")
             elif (_value := _loaded_values[_key]) is not None:
-                _param.set(jax.numpy.array(_value))
+                # numpy has no native bfloat16 type and stores it as raw 2-byte values.
+                if _value.dtype.kind == "V" and _value.dtype.itemsize == 2:
+                    _value = _value.view(jax.numpy.bfloat16)
+                _targets.append(_param)
+                _values.append(_value)
     
     _loaded_values.close()
+
+    # Transfer all the values to the device at once, instead of one array at a time.
+    for _param, _value in zip(_targets, jax.device_put(_values)):
+        # Restore the original dtype if the parameters were saved with a different one.
+        if (_dtype := getattr(_param.get(), "dtype", None)) is not None and _dtype != _value.dtype:
+            _value = _value.astype(_dtype)
+        _param.set(_value)
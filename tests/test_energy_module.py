@@ -0,0 +1,53 @@
+import jax
+import jax.numpy as jnp
+
+import pcax.predictive_coding as pxc
+import pcax.utils as pxu
+import pcax.functional as pxf
+
+
+class Empty(pxc.EnergyModule):
+    pass
+
+
+class Model(pxc.EnergyModule):
+    def __init__(self):
+        super().__init__()
+        self.vode = pxc.Vode((3,))
+        self.empty = Empty()
+
+    def __call__(self, x):
+        return self.vode(jax.nn.tanh(x))
+
+
+@pxf.vmap(pxu.Mask(pxc.VodeParam | pxc.VodeParam.Cache, (None, 0)), in_axes=0, out_axes=0)
+def batch_energy(x, *, model):
+    model(x)
+    return model.energy()
+
+
+def test_empty_module_energy():
+    assert Empty().energy().shape == ()
+    assert Empty().energy() == 0.0
+
+
+def test_nested_empty_module_energy():
+    model = Model()
+    x = jnp.ones((5, 3))
+
+    # Inside vmap, the zero energy of 'empty' is summed to the energy of each sample.
+    with pxu.step(model, pxc.STATUS.INIT, clear_params=pxc.VodeParam.Cache):
+        batch_energy(x, model=model)
+    with pxu.step(model, clear_params=pxc.VodeParam.Cache):
+        e = batch_energy(x, model=model)
+    assert e.shape == (5,)
+
+    # Outside vmap, the scalar zero energy of 'empty' must broadcast to the batched energy of the vode.
+    with pxu.step(model, pxc.STATUS.INIT, clear_params=pxc.VodeParam.Cache):
+        model(x)
+    with pxu.step(model, clear_params=pxc.VodeParam.Cache):
+        model(x)
+        e, e_vode = model.energy(), model.vode.energy()
+    assert e_vode.shape != ()
+    assert e.shape == e_vode.shape
+    assert jnp.allclose(e, e_vode)
@@ -0,0 +1,13 @@
+import pickle
+
+import jax.numpy as jnp
+
+import pcax as px
+
+
+def test_params_pickle():
+    param = pickle.loads(pickle.dumps(px.Param(jnp.ones((2,)))))
+    static = pickle.loads(pickle.dumps(px.static("value")))
+
+    assert (param.get() == jnp.ones((2,))).all()
+    assert static.get() == "value"
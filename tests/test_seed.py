@@ -0,0 +1,50 @@
+import importlib.util
+import os
+import pickle
+import subprocess
+import sys
+
+import pytest
+
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(__file__), "..", "examples", "s4_1_discriminative_mode")
+
+
+def _load_in_subprocess(data: bytes, code: str) -> str:
+    """Unpickles 'data' as 'obj' in a fresh python process (i.e., like a ray worker) and runs 'code' on it."""
+    r = subprocess.run(
+        [sys.executable, "-c", f"import sys, pickle\nobj = pickle.loads(sys.stdin.buffer.read())\n{code}"],
+        input=data,
+        capture_output=True,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join((EXAMPLES_DIR, *sys.path))},
+    )
+    assert r.returncode == 0, r.stderr.decode()
+
+    return r.stdout.decode().strip()
+
+
+def test_run_info_pickles_to_worker(monkeypatch):
+    pytest.importorskip("torch")
+    omegaconf = pytest.importorskip("omegaconf")
+    monkeypatch.syspath_prepend(EXAMPLES_DIR)
+    import seed
+
+    run_info = seed.RunInfo(omegaconf.OmegaConf.create({"hp": {"a": {"default": 3}, "b": "${hp:a}"}}))
+
+    assert _load_in_subprocess(pickle.dumps(run_info), "print(obj['hp/b'])") == "3"
+
+
+def test_main_pickles_to_worker():
+    # Scripts pass their '__main__.main' to 'seed.run', which ray pickles by value together with the (jitted) globals
+    # it refers to.
+    pytest.importorskip("torch")
+    pytest.importorskip("torchvision")
+    pytest.importorskip("omegacli")
+    cloudpickle = pytest.importorskip("cloudpickle")
+
+    path = os.path.join(EXAMPLES_DIR, "VGG5", "cifar10", "PC_SE.py")
+    spec = importlib.util.spec_from_file_location("__pc_se_main__", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    assert _load_in_subprocess(cloudpickle.dumps(module.main), "print(callable(obj))") == "True"